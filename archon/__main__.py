@@ -35,6 +35,14 @@ from archon.actor.actor import ArchonActor
 def archon(ctx, config_file, verbose):
     """Archon controller"""
 
+    # Use the faster uvloop event loop, if it is installed.
+    try:
+        import uvloop
+
+        uvloop.install()
+    except ImportError:
+        pass
+
     ctx.obj = {"verbose": verbose, "config_file": config_file}
 
 
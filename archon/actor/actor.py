@@ -9,9 +9,14 @@
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
+import multiprocessing
 import os
+import pathlib
 import warnings
-from contextlib import suppress
+from contextlib import ExitStack, suppress
+
+from typing import IO, Optional
 
 from clu.actor import AMQPActor
 
@@ -21,6 +26,7 @@ from archon.controller.controller import ArchonController
 from archon.exceptions import ArchonUserWarning
 
 from .commands import parser as archon_command_parser
+from .tools import open_with_lock
 
 __all__ = ["ArchonActor"]
 
@@ -63,6 +69,23 @@ class ArchonActor(AMQPActor):
 
         self._exposing: bool = False
 
+        # Process pool used to compress the HDUs of each CCD in parallel. It's only
+        # created the first time that a compressed file is written.
+        self._fits_pool: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+        # Mapping of controller name to a list of (ccd_name, (x0, y0, x1, y1)) regions.
+        # Filled from the configuration the first time each controller is read.
+        self._ccd_regions: dict[str, list[tuple[str, tuple[int, ...]]]] = {}
+
+        # The next exposure number is kept in memory and saved to the
+        # nextExposureNumber file in the background. The file is kept open and locked
+        # while the actor runs so that other processes cannot use the same sequence.
+        self._next_exp_no: Optional[int] = None
+        self._next_exp_file: Optional[IO[str]] = None
+        self._exp_no_lock = asyncio.Lock()
+        self._exp_no_task: Optional[asyncio.Task] = None
+        self._exit_stack = ExitStack()
+
     async def start(self):
         """Start the actor and connect the controllers."""
 
@@ -77,6 +100,22 @@ class ArchonActor(AMQPActor):
                     ArchonUserWarning,
                 )
 
+        # If the exposure number cannot be loaded now, _get_exposure_no() will try
+        # again when the first exposure is taken.
+        try:
+            self._load_exposure_no()
+        except BlockingIOError:
+            warnings.warn(
+                "The nextExposureNumber file is locked. This probably "
+                "indicates that another spectrograph process is running.",
+                ArchonUserWarning,
+            )
+        except OSError as err:
+            warnings.warn(
+                f"Cannot load the nextExposureNumber file: {err}",
+                ArchonUserWarning,
+            )
+
         await super().start()
 
         self._fetch_log_jobs = [
@@ -94,6 +133,11 @@ class ArchonActor(AMQPActor):
             for task in self._fetch_log_jobs:
                 task.cancel()
                 await task
+        if self._exp_no_task:
+            await self._exp_no_task
+        self._exit_stack.close()
+        if self._fits_pool:
+            self._fits_pool.shutdown(wait=False)
         return super().stop()
 
     @classmethod
@@ -121,6 +165,92 @@ class ArchonActor(AMQPActor):
         # easily know if the timing script is running.
         return self._exposing
 
+    def _get_fits_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        """Returns the process pool used to compress the HDUs, creating it if needed.
+
+        The workers are spawned instead of forked so that they do not inherit the
+        event loop or the open connections of the actor.
+        """
+        if self._fits_pool is None:
+            self._fits_pool = concurrent.futures.ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._fits_pool
+
+    def _get_ccd_regions(
+        self,
+        controller_name: str,
+    ) -> list[tuple[str, tuple[int, ...]]]:
+        """Returns the name and ``(x0, y0, x1, y1)`` region of each CCD in a buffer.
+
+        Returns an empty list if the CCDs of the controller are not defined in the
+        configuration. The regions are only built once for each controller.
+        """
+        if controller_name not in self._ccd_regions:
+            controllers = self.config.get("controllers", {})
+            ccds = controllers.get(controller_name, {}).get("ccds", {})
+            self._ccd_regions[controller_name] = [
+                (ccd, tuple(region)) for ccd, region in ccds.items()
+            ]
+        return self._ccd_regions[controller_name]
+
+    def _load_exposure_no(self):
+        """Opens and locks the nextExposureNumber file and reads the sequence."""
+        data_dir = pathlib.Path(self.config["files"]["data_dir"])
+        data_dir.mkdir(parents=True, exist_ok=True)
+
+        # We store the next exposure number in a file at the root of the data directory.
+        next_exp_file = data_dir / "nextExposureNumber"
+        next_exp_file.touch(exist_ok=True)
+
+        fd = self._exit_stack.enter_context(open_with_lock(next_exp_file, "r+"))
+        data = fd.read().strip()
+
+        self._next_exp_file = fd
+        self._next_exp_no = int(data) if data != "" else 1
+
+    async def _get_exposure_no(self) -> int:
+        """Returns a new exposure number and increases the sequence.
+
+        The new value of the sequence is written to disk in the background.
+
+        Raises
+        ------
+        BlockingIOError
+            If the nextExposureNumber file is locked by another process.
+        OSError
+            If the data directory or the nextExposureNumber file cannot be created
+            or opened.
+        """
+        async with self._exp_no_lock:
+            if self._next_exp_no is None:
+                self._load_exposure_no()
+            assert self._next_exp_no is not None
+
+            exp_no = self._next_exp_no
+            self._next_exp_no += 1
+
+        if self._exp_no_task is None or self._exp_no_task.done():
+            self._exp_no_task = asyncio.create_task(self._save_exposure_no())
+
+        return exp_no
+
+    async def _save_exposure_no(self):
+        """Writes the next exposure number until the file is up to date."""
+
+        def write(value: int):
+            assert self._next_exp_file
+            self._next_exp_file.seek(0)
+            self._next_exp_file.truncate()
+            self._next_exp_file.write(str(value))
+            self._next_exp_file.flush()
+
+        loop = asyncio.get_running_loop()
+        saved = None
+        while saved != self._next_exp_no:
+            saved = self._next_exp_no
+            await loop.run_in_executor(None, write, saved)
+
     async def _fetch_log(self, controller: ArchonController):
         """Fetches the log and outputs new messages.
 
@@ -9,16 +9,17 @@
 from __future__ import annotations
 
 import asyncio
+import concurrent.futures
 import os
 import pathlib
-from contextlib import suppress
-from functools import partial
+import tempfile
 
 from typing import Any, Optional
 
 import astropy.time
 import click
 import fitsio
+import numpy
 from clu.command import Command
 
 import archon.actor
@@ -26,16 +27,100 @@ from archon.controller.controller import ArchonController
 from archon.controller.maskbits import ControllerStatus
 from archon.exceptions import ArchonError
 
-from ..tools import check_controller, controller_list, open_with_lock
+from ..tools import check_controller, controller_list
 from . import parser
 
 
+def _write_fits(file_path: str, ccd_data: dict[str, numpy.ndarray]):
+    """Writes the data of each CCD as an HDU in a new FITS file.
+
+    This function is blocking and is meant to be run in an executor.
+    """
+    with fitsio.FITS(file_path, "rw") as fits:
+        for ccd_name, data in ccd_data.items():
+            fits.create_image_hdu(data, extname=ccd_name)
+
+
+def _compress_hdu(data: numpy.ndarray, extname: str, compress: str) -> bytes:
+    """Tile-compresses an image and returns the contents of the resulting FITS file.
+
+    The file contains an empty primary HDU followed by the compressed extension. This
+    function is meant to be run in a process pool.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "hdu.fits")
+        with fitsio.FITS(path, "rw") as fits:
+            fits.create_image_hdu(data, extname=extname, compress=compress)
+        with open(path, "rb") as fd:
+            return fd.read()
+
+
+def _primary_hdu_size(raw: bytes) -> int:
+    """Returns the size in bytes of a dataless primary HDU."""
+    for card_start in range(0, len(raw), 80):
+        if raw[card_start : card_start + 8] == b"END     ":
+            # The header is padded to a multiple of 2880 bytes.
+            return (card_start // 2880 + 1) * 2880
+    raise ArchonError("Cannot find the end of the primary header.")
+
+
+def _merge_fits(file_path: str, hdu_files: list[bytes]):
+    """Writes a FITS file with the extensions of several single-extension files."""
+    with open(file_path, "wb") as fd:
+        fd.write(hdu_files[0])
+        for raw in hdu_files[1:]:
+            fd.write(raw[_primary_hdu_size(raw) :])
+
+
+async def _write_fits_compressed(
+    pool: concurrent.futures.Executor,
+    file_path: str,
+    ccd_data: dict[str, numpy.ndarray],
+    compress: str,
+):
+    """Writes a FITS file compressing each CCD in parallel in ``pool``."""
+    loop = asyncio.get_running_loop()
+    hdu_files = await asyncio.gather(
+        *[
+            loop.run_in_executor(pool, _compress_hdu, data, ccd_name, compress)
+            for ccd_name, data in ccd_data.items()
+        ]
+    )
+    await loop.run_in_executor(None, _merge_fits, file_path, hdu_files)
+
+
+async def _wait_for_buffer(
+    controller: ArchonController,
+    buffer_no: int,
+    max_probe_interval: float = 1.0,
+):
+    """Waits until a frame buffer is complete.
+
+    Any call to `.ArchonController.get_frame` that sees the buffer complete wakes us up
+    immediately. If nothing happens we query the frame ourselves, in case nobody else is
+    doing it, starting after 50 ms and doubling the interval up to
+    ``max_probe_interval`` seconds.
+    """
+    key = f"buf{buffer_no}complete"
+    probe_interval = 0.05
+    while controller._frame_info.get(key) != 1:
+        controller._frame_complete.clear()
+        try:
+            await asyncio.wait_for(
+                controller._frame_complete.wait(),
+                timeout=probe_interval,
+            )
+        except asyncio.TimeoutError:
+            await controller.get_frame()
+            probe_interval = min(probe_interval * 2, max_probe_interval)
+
+
 async def _do_one_controller(
     command: Command[archon.actor.ArchonActor],
     controller: ArchonController,
     exposure_params: dict[str, Any],
     exp_no: int,
-    mjd_dir: pathlib.Path,
+    path_template: str,
 ) -> bool:
     """Does the heavy lifting of exposing and writing a single controller."""
 
@@ -43,8 +128,7 @@ async def _do_one_controller(
     hemisphere = "n" if observatory == "apo" else "s"
 
     config = command.actor.config
-    path: pathlib.Path = mjd_dir / config["files"]["template"]
-    file_path = str(path.absolute()).format(
+    file_path = path_template.format(
         exposure_no=exp_no,
         controller=controller.name,
         observatory=observatory,
@@ -84,17 +168,39 @@ async def _do_one_controller(
     # Start integration. _Changgon
     await controller.integrate(exposure_time=exp_time)
 
-    # Wait until the exposure is complete.
-    # TODO: Here we should take into account the network and mechanical delay in
-    # opening the shutter.
-    await asyncio.sleep(exp_time)
+    # Wait until the exposure is complete. The close command is sent close_lead_ms
+    # before the end of the integration to account for the network and mechanical
+    # delays in closing the shutter.
+    shutter_lead = config.get("shutter", {}).get("close_lead_ms", 0) / 1000.0
+    await asyncio.sleep(max(0, exp_time - shutter_lead))
 
     # Close shutter (placeholder)
 
     # Close the shutter. Note the double await.
-    shutter_cmd_close = await (await command.actor.send_command("osu_actor", "close"))
+    async def close_shutter():
+        return await (await command.actor.send_command("osu_actor", "close"))
+
+    async def get_readout_frame():
+        # Wait a little bit and check that we are reading out to a new buffer
+        await asyncio.sleep(0.1)
+        return await controller.get_frame()
+
+    # Block until the shutter command is done (finished or failed) while we check
+    # that the readout has started. If either fails, or if we are cancelled, make
+    # sure that the other task does not keep running on its own.
+    close_task = asyncio.create_task(close_shutter())
+    readout_task: Optional[asyncio.Task] = None
+    try:
+        await asyncio.sleep(min(shutter_lead, exp_time))
+        readout_task = asyncio.create_task(get_readout_frame())
+        shutter_cmd_close, frame_info = await asyncio.gather(close_task, readout_task)
+    except BaseException:
+        tasks = [task for task in (close_task, readout_task) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
 
-    await shutter_cmd_close  # Block until the command is done (finished or failed)
     if shutter_cmd_close.status.did_fail:
         # Do cleanup
         return command.fail(text="Shutter failed to close")
@@ -107,11 +213,6 @@ async def _do_one_controller(
 
     command.info(f"Shutter is now {shutter_status_close!r}.")
 
-    # Wait a little bit and check that we are reading out to a new buffer
-    await asyncio.sleep(0.1)
-
-    # Get new frame info
-    frame_info = await controller.get_frame()
     wbuf = frame_info["wbuf"]
     if frame_info[f"buf{wbuf}complete"] != 0:
         controller.status = ControllerStatus.ERROR
@@ -125,19 +226,14 @@ async def _do_one_controller(
         )
     )
     # Wait until buffer is complete.
-    elapsed = 0
-    while True:
-        frame_info = await controller.get_frame()
-        if frame_info[f"buf{wbuf}complete"] == 1:
-            break
-        if elapsed > config["timeouts"]["readout_max"]:
-            controller.status = ControllerStatus.ERROR
-            raise ArchonError("Timed out waiting for read-out to finish.")
-        await asyncio.sleep(1.0)  # Sleep for one second before asking again.
-        elapsed += 1
-
-    # Reset timing
-    await controller.reset()
+    try:
+        await asyncio.wait_for(
+            _wait_for_buffer(controller, wbuf),
+            timeout=config["timeouts"]["readout_max"],
+        )
+    except asyncio.TimeoutError:
+        controller.status = ControllerStatus.ERROR
+        raise ArchonError("Timed out waiting for read-out to finish.")
 
     # Fetch buffer data
     command.debug(
@@ -146,9 +242,27 @@ async def _do_one_controller(
             text=f"Fetching buffer {wbuf}.",
         )
     )
-    data = await controller.fetch(wbuf)
+    # _wait_for_buffer() has just retrieved the frame information with the buffer
+    # complete, so there is no need to ask for it again. If the CCDs of this controller
+    # are not defined, the whole buffer is saved in a single HDU.
+    ccd_regions = command.actor._get_ccd_regions(controller.name)
+    if len(ccd_regions) > 0:
+        ccd_data = await controller.fetch_split(
+            ccd_regions,
+            buffer_no=wbuf,
+            frame_info=controller._frame_info,
+        )
+    else:
+        ccd_data = {
+            controller.name: await controller.fetch(
+                buffer_no=wbuf,
+                frame_info=controller._frame_info,
+            )
+        }
 
-    # Divide array into CCDs and create FITS.
+    # Create the FITS with one HDU for each CCD while we reset the timing of the
+    # controller. Uncompressed files are written in a single executor job; if the HDUs
+    # are compressed, each CCD is compressed in parallel in a process pool.
     # TODO: add at least a placeholder header with some basics.
     command.debug(
         text=dict(
@@ -158,14 +272,13 @@ async def _do_one_controller(
     )
 
     loop = asyncio.get_running_loop()
-    ccd_info = config["controllers"][controller.name]["ccds"]
-    fits = fitsio.FITS(file_path, "rw")
-    for ccd_name in ccd_info:
-        region = ccd_info[ccd_name]
-        ccd_data = data[region[1] : region[3], region[0] : region[2]]
-        fits_write = partial(fits.create_image_hdu, extname=ccd_name)
-        await loop.run_in_executor(None, fits_write, ccd_data)
-    await loop.run_in_executor(None, fits.close)
+    compress = config["files"].get("compress", None)
+    if compress:
+        pool = command.actor._get_fits_pool()
+        write_job = _write_fits_compressed(pool, file_path, ccd_data, compress)
+    else:
+        write_job = loop.run_in_executor(None, _write_fits, file_path, ccd_data)
+    await asyncio.gather(write_job, controller.reset())
 
     command.info(text=f"File {os.path.basename(file_path)} written to disk.")
 
@@ -184,70 +297,72 @@ async def _do_exposures(
     now = astropy.time.Time.now()
     mjd = int(now.mjd)
 
-    # Get data directory or create it if it doesn't exist.
+    # Get the directory for this MJD or create it (and the data directory).
     data_dir = pathlib.Path(config["files"]["data_dir"])
-    if not data_dir.exists():
-        data_dir.mkdir(parents=True)
-
-    # We store the next exposure number in a file at the root of the data directory.
-    next_exp_file = data_dir / "nextExposureNumber"
-    if not next_exp_file.exists():
-        next_exp_file.touch()
-
-    # Get the directory for this MJD or create it.
     mjd_dir = data_dir / str(mjd)
-    if not mjd_dir.exists():
-        mjd_dir.mkdir(parents=True)
+    mjd_dir.mkdir(parents=True, exist_ok=True)
+
+    # Resolve the absolute path template once for all the controllers. Tile-compressed
+    # files are written as plain FITS, so they must not be named .gz.
+    template = config["files"]["template"]
+    if config["files"].get("compress", None) and template.endswith(".gz"):
+        command.warning(
+            text="Tile compression is enabled. Removing the .gz suffix "
+            "from the file template."
+        )
+        template = template[: -len(".gz")]
+    path_template = str((mjd_dir / template).resolve())
 
     try:
-        with open_with_lock(next_exp_file, "r+") as fd:
-            fd.seek(0)
-            data = fd.read().strip()
-            next_exp_no: int = int(data) if data != "" else 1
-
-            _jobs: list[asyncio.Task] = []
-            for controller in controllers:
-                _jobs.append(
-                    asyncio.create_task(
-                        _do_one_controller(
-                            command,
-                            controller,
-                            exposure_params,
-                            next_exp_no,
-                            mjd_dir,
-                        )
-                    )
-                )
-
-            try:
-                results = await asyncio.gather(*_jobs, return_exceptions=False)
-            except BaseException as err:
-                command.error(error=str(err))
-                command.error("One controller failed. Cancelling remaining tasks.")
-                for job in _jobs:
-                    if not job.done():
-                        with suppress(asyncio.CancelledError):
-                            job.cancel()
-                            await job
-                return False
-
-            if not all(results):
-                return False
-
-            # Increment nextExposureNumber
-            # TODO: Should we increase the sequence regardless of whether the exposure
-            # fails or not?
-            fd.seek(0)
-            fd.truncate()
-            fd.seek(0)
-            fd.write(str(next_exp_no + 1))
-
+        next_exp_no = await command.actor._get_exposure_no()
     except BlockingIOError:
         command.error(
             error="The nextExposureNumber file is locked. This probably "
             "indicates that another spectrograph process is running."
         )
         return False
+    except OSError as err:
+        command.error(error=f"Cannot load the nextExposureNumber file: {err}")
+        return False
+
+    _jobs: list[asyncio.Task] = []
+    for controller in controllers:
+        _jobs.append(
+            asyncio.create_task(
+                _do_one_controller(
+                    command,
+                    controller,
+                    exposure_params,
+                    next_exp_no,
+                    path_template,
+                )
+            )
+        )
+
+    try:
+        done, pending = await asyncio.wait(
+            _jobs,
+            return_when=asyncio.FIRST_EXCEPTION,
+        )
+    except asyncio.CancelledError:
+        for job in _jobs:
+            job.cancel()
+        raise
+
+    if any([job.exception() is not None for job in done]):
+        if len(pending) > 0:
+            command.error("One controller failed. Cancelling remaining tasks.")
+            for job in pending:
+                job.cancel()
+            await asyncio.wait(pending)
+        # Report all the errors, including those raised while cancelling.
+        for job in _jobs:
+            if not job.cancelled() and job.exception() is not None:
+                command.error(error=str(job.exception()))
+        return False
+
+    if not all([job.result() for job in done]):
+        return False
 
     return True
 
@@ -98,6 +98,9 @@ def parallel_controllers(check=True):
             if len(pending) > 0:
                 for p in pending:
                     p.cancel()
+                await asyncio.wait(pending)
+
+            if any([task.exception() is not None for task in done]):
                 return command.fail("Some tasks raised exceptions.")
 
             results = [task.result() for task in done]
@@ -152,14 +155,10 @@ def open_with_lock(
     BlockingIOError
         If the file is already locked.
     """
-    # Open the file in read-only mode first to see if it's already locked.
-    fd = open(filename, "r")
-    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    # This will cause a BlockingIOError unless not locked.
-    fcntl.flock(fd, fcntl.LOCK_UN)
-
-    # Now really open.
     with open(filename, mode) as fd:
+        # This will cause a BlockingIOError if the file is already locked.
         fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        yield fd
-        fcntl.flock(fd, fcntl.LOCK_UN)
+        try:
+            yield fd
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
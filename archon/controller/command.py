@@ -10,10 +10,9 @@ from __future__ import annotations
 
 import asyncio
 import enum
-import re
 import warnings
 
-from typing import AsyncGenerator, Optional
+from typing import Any, AsyncGenerator, Callable, Optional
 
 from archon.exceptions import ArchonError, ArchonUserWarning
 from archon.tools import Timer
@@ -22,7 +21,15 @@ from . import MAX_COMMAND_ID
 
 __all__ = ["ArchonCommand", "ArchonCommandStatus", "ArchonCommandReply"]
 
-REPLY_RE = re.compile(b"^([<|?])([0-9A-F]{2})(:?)(.*)\n?$")
+# Replies have the format <xxRESPONSE, ?xx, or <xx:BINARY, with xx the command id in
+# uppercase hexadecimal. They are parsed by position instead of with a regex.
+REPLY_TYPES = {ord("<"): "<", ord("|"): "|", ord("?"): "?"}
+HEX_DIGITS = b"0123456789ABCDEF"
+
+# Prefix of the raw command and hexadecimal id as it appears in the replies, for each
+# command id. Built once so that creating a command does not need to format the id.
+_RAW_PREFIXES = [f">{command_id:02X}" for command_id in range(MAX_COMMAND_ID + 1)]
+_CID_BYTES = [prefix[1:].encode() for prefix in _RAW_PREFIXES]
 
 
 class ArchonCommandStatus(enum.Enum):
@@ -53,6 +60,9 @@ class ArchonCommand(asyncio.Future):
     timeout
         Time without receiving a reply after which the command will be timed out.
         `None` disables the timeout.
+    on_done
+        A callback to call with the command as soon as the command is done,
+        whether it succeeded, failed, timed out, or was cancelled.
     """
 
     def __init__(
@@ -62,6 +72,7 @@ class ArchonCommand(asyncio.Future):
         controller=None,
         expected_replies: Optional[int] = 1,
         timeout: Optional[float] = None,
+        on_done: Optional[Callable[[ArchonCommand], Any]] = None,
     ):
         super().__init__()
 
@@ -69,6 +80,7 @@ class ArchonCommand(asyncio.Future):
         self.command_id = command_id
         self.controller = controller
         self._expected_replies = expected_replies
+        self._on_done = on_done
 
         #: List of str or bytes: List of replies received for this command.
         self.replies: list[ArchonCommandReply] = []
@@ -81,14 +93,15 @@ class ArchonCommand(asyncio.Future):
                 f"command_id must be between 0x00 and 0x{MAX_COMMAND_ID:X}"
             )
 
+        #: str: The raw command sent to the Archon (without the newline).
+        self.raw = _RAW_PREFIXES[self.command_id] + self.command_string
+
+        # Hexadecimal command id as it appears in the replies, e.g. b"0A".
+        self._cid_bytes = _CID_BYTES[self.command_id]
+
         self.timer: Optional[Timer] = Timer(timeout, self._timeout) if timeout else None
         self.__event = asyncio.Event()
 
-    @property
-    def raw(self):
-        """Returns the raw command sent to the Archon (without the newline)."""
-        return f">{self.command_id:02X}{self.command_string}"
-
     def process_reply(self, reply: bytes) -> ArchonCommandReply | None:
         """Processes a new reply to this command.
 
@@ -104,20 +117,21 @@ class ArchonCommand(asyncio.Future):
         reply
             The received reply, as bytes.
         """
-        try:
-            archon_reply = ArchonCommandReply(reply, self)
-        except ArchonError as err:
-            warnings.warn(str(err), ArchonUserWarning)
-            self._mark_done(self.status.FAILED)
-            return
-
-        if archon_reply.command_id != self.command_id:
+        # Reject replies to other commands before parsing them.
+        if reply[1:3] != self._cid_bytes:
             warnings.warn(
                 f"Received reply to command {self.raw} that does not match "
                 f"the command id: {reply.decode()}",
                 ArchonUserWarning,
             )
-            self._mark_done(self.status.FAILED)
+            self._mark_done(ArchonCommandStatus.FAILED)
+            return
+
+        try:
+            archon_reply = ArchonCommandReply(reply, self)
+        except ArchonError as err:
+            warnings.warn(str(err), ArchonUserWarning)
+            self._mark_done(ArchonCommandStatus.FAILED)
             return
 
         self.replies.append(archon_reply)
@@ -126,7 +140,7 @@ class ArchonCommand(asyncio.Future):
             self.timer.reset()
 
         if archon_reply.type == "?":
-            self._mark_done(self.status.FAILED)
+            self._mark_done(ArchonCommandStatus.FAILED)
             return archon_reply
 
         if self._expected_replies and len(self.replies) == self._expected_replies:
@@ -153,7 +167,7 @@ class ArchonCommand(asyncio.Future):
         Returns `True` if the command succeeded, or `False` if it failed, timed out, or
         if the command is not yet done.
         """
-        return self.status == self.status.DONE
+        return self.status == ArchonCommandStatus.DONE
 
     def _mark_done(self, status: ArchonCommandStatus = ArchonCommandStatus.DONE):
         """Marks the command done with ``status``."""
@@ -165,14 +179,23 @@ class ArchonCommand(asyncio.Future):
         self.status = status
         if not self.done():
             self.set_result(self)
+            if self._on_done:
+                self._on_done(self)
 
-        # Return ID to the pool
-        if self.controller:
-            self.controller._id_pool.add(self.command_id)
+    def cancel(self, *args, **kwargs) -> bool:
+        """Cancels the command, calling the ``on_done`` callback."""
+        if self.timer:
+            self.timer.cancel()
+
+        cancelled = super().cancel(*args, **kwargs)
+        if cancelled and self._on_done:
+            self._on_done(self)
+
+        return cancelled
 
     def _timeout(self):
         """Marks the command timed out."""
-        self._mark_done(self.status.TIMEDOUT)
+        self._mark_done(ArchonCommandStatus.TIMEDOUT)
 
     def __repr__(self):
         return f"<ArchonCommand ({self.raw}, status={self.status})>"
@@ -199,8 +222,12 @@ class ArchonCommandReply:
     """
 
     def __init__(self, raw_reply: bytes, command: ArchonCommand):
-        parsed = REPLY_RE.match(raw_reply)
-        if not parsed:
+        if (
+            len(raw_reply) < 3
+            or raw_reply[0] not in REPLY_TYPES
+            or raw_reply[1] not in HEX_DIGITS
+            or raw_reply[2] not in HEX_DIGITS
+        ):
             raise ArchonError(
                 f"Received unparseable reply to command "
                 f"{command.raw}: {raw_reply.decode()}"
@@ -209,21 +236,28 @@ class ArchonCommandReply:
         self.command = command
         self.raw_reply = raw_reply
 
-        rtype, rcid, rbin, rmessage = parsed.groups()
-        self.type: str = rtype.decode()
+        rcid = raw_reply[1:3]
+        self.type: str = REPLY_TYPES[raw_reply[0]]
         self.command_id: int = int(rcid, 16)
-        self.is_binary: bool = rbin.decode() == ":"
+        self.is_binary: bool = raw_reply[3:4] == b":"
 
-        self.reply: str | bytes
-        if self.is_binary:
-            # If the reply is binary, remove the prefixes and save the full
-            # content as the reply.
-            self.reply = raw_reply.replace(b"<" + rcid + b":", b"")
-        else:
-            self.reply = rmessage.decode().strip()
+        # If the reply is binary, the full content after the prefix is the reply. The
+        # listener stores the payload of all the binary chunks contiguously, so there
+        # is only one prefix. The payload can be the size of a whole frame, so it is
+        # only copied out of the raw reply the first time that reply is accessed.
+        self._reply: str | bytes | bytearray | None = None
+        if not self.is_binary:
+            self._reply = raw_reply[3:].decode().strip()
+
+    @property
+    def reply(self) -> str | bytes | bytearray:
+        """The reply without the reply code and command id."""
+        if self._reply is None:
+            self._reply = self.raw_reply[4:]
+        return self._reply
 
     def __str__(self) -> str:
-        if isinstance(self.reply, bytes):
+        if isinstance(self.reply, (bytes, bytearray)):
             raise ArchonError("The reply is binary and cannot be converted to string.")
         return self.reply
 
@@ -9,18 +9,22 @@
 from __future__ import annotations
 
 import asyncio
+import collections
 import configparser
+import functools
+import io
+import itertools
 import os
-import re
 import warnings
 from collections.abc import AsyncIterator
 
-from typing import Any, Callable, Iterable, Optional
+from typing import Any, Callable, Iterable, Optional, Sequence
 
 import numpy
 from clu.device import Device
 
-from archon.controller.command import ArchonCommand
+from archon import log
+from archon.controller.command import HEX_DIGITS, REPLY_TYPES, ArchonCommand
 from archon.controller.maskbits import ControllerStatus, ModType
 from archon.exceptions import ArchonError, ArchonUserWarning
 
@@ -28,6 +32,50 @@ from . import MAX_COMMAND_ID, MAX_CONFIG_LINES
 
 __all__ = ["ArchonController"]
 
+# Only one in this many invalid replies is reported as a warning. The rest are
+# logged as debug messages.
+_INVALID_REPLY_WARN_EVERY = 100
+
+# Byte values of the characters that mark the end of the header of a reply.
+_NEWLINE = ord(b"\n")
+_COLON = ord(b":")
+
+# Four-digit hexadecimal config line numbers for RCONFIG and WCONFIG.
+_HEX4 = [f"{n_line:04X}" for n_line in range(MAX_CONFIG_LINES)]
+
+# Lowercase name and integer base of each FRAME keyword. The timestamps are in
+# hexadecimal. The FRAME reply always has the same keywords, so they are only
+# classified the first time they are seen.
+_FRAME_KEYS: dict[str, tuple[str, int]] = {}
+
+# The RCONFIG commands are the same for every read, so they are built only once.
+_RCONFIG_CMDS = tuple("RCONFIG" + hex4 for hex4 in _HEX4)
+
+
+@functools.lru_cache(maxsize=64)
+def _modtype_name(value: int) -> str:
+    """Returns the name of the module type ``value``."""
+    return ModType(value).name
+
+
+def _new_acf_parser() -> configparser.ConfigParser:
+    """Returns a case-sensitive parser for ACF configuration files."""
+    c = configparser.ConfigParser()
+    c.optionxform = str  # Make it case-sensitive
+    return c
+
+
+def _write_acf(path: str, text: str):
+    """Writes an ACF configuration file. Blocking; meant to run in an executor."""
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _reply_text(cmd: ArchonCommand) -> str:
+    """Returns the text of the first reply to a command."""
+    reply = cmd.replies[0].reply
+    return reply if isinstance(reply, str) else reply.decode()
+
 
 class ArchonController(Device):
     """Talks to an Archon controller over TCP/IP.
@@ -43,9 +91,6 @@ class ArchonController(Device):
         A name identifying this controller.
     """
 
-    __running_commands: dict[int, ArchonCommand] = {}
-    _id_pool = set(range(MAX_COMMAND_ID))
-
     def __init__(self, host: str, port: int = 4242, name: str = ""):
         Device.__init__(self, host, port)
 
@@ -53,11 +98,26 @@ class ArchonController(Device):
         self._status: ControllerStatus = ControllerStatus.UNKNOWN
         self.__status_event = asyncio.Event()
 
-        self._binary_reply: Optional[bytearray] = None
+        # Commands that are running, by command id, and the ids that are available.
+        # They are kept per controller so that different controllers do not compete
+        # for the same ids. Freed ids are appended to the end of the pool, so that
+        # they are not reused immediately.
+        self.__running_commands: dict[int, ArchonCommand] = {}
+        self._id_pool = collections.deque(range(MAX_COMMAND_ID))
+
+        # Number of invalid replies received, used to rate-limit their warnings.
+        self._n_invalid_replies: int = 0
+
+        # Buffer for binary replies. It's allocated once and only grows if a larger
+        # reply is expected. _binary_reply_size is the size of the binary reply
+        # currently expected, or zero if we are not expecting one.
+        self._binary_reply = bytearray()
+        self._binary_reply_size: int = 0
 
-        # TODO: asyncio recommends using asyncio.create_task directly, but that
-        # call get_running_loop() which fails in iPython.
-        self._job = asyncio.get_event_loop().create_task(self.__track_commands())
+        # Last frame information received and an event that is set every time
+        # get_frame() sees a buffer transitioning to complete.
+        self._frame_info: dict[str, int] = {}
+        self._frame_complete = asyncio.Event()
 
     @property
     def status(self) -> ControllerStatus:
@@ -96,24 +156,55 @@ class ArchonController(Device):
         kwargs
             Other keyword arguments to pass to `.ArchonCommand`.
         """
-        command_id = command_id or self._get_id()
-        if command_id > MAX_COMMAND_ID or command_id < 0:
+        if command_id is None:
+            command_id = self._get_id()
+        elif command_id > MAX_COMMAND_ID or command_id < 0:
             raise ArchonError(
                 f"Command ID must be in the range [0, {MAX_COMMAND_ID:d}]."
             )
+        elif command_id in self.__running_commands:
+            raise ArchonError(f"Command ID {command_id} is already in use.")
+        elif command_id in self._id_pool:
+            # If the id was chosen by the caller, take it out of the pool while the
+            # command is running. It's returned to the pool when the command is done.
+            self._id_pool.remove(command_id)
+
+        command = self._new_command(command_string, command_id, **kwargs)
+        self.write(command.raw)
+
+        return command
 
+    def _new_command(
+        self,
+        command_string: str,
+        command_id: int,
+        **kwargs,
+    ) -> ArchonCommand:
+        """Creates a new command and tracks it as running, without sending it.
+
+        ``command_id`` must already have been taken out of the pool.
+        """
         command = ArchonCommand(
             command_string,
             command_id,
             controller=self,
+            on_done=self._on_command_done,
             **kwargs,
         )
         self.__running_commands[command_id] = command
 
-        self.write(command.raw)
-
         return command
 
+    async def _write_many(self, commands: Iterable[ArchonCommand]):
+        """Sends several commands to the Archon with a single write.
+
+        Waits until the write buffer has been flushed, so that large batches
+        do not accumulate in the transport faster than they can be sent.
+        """
+        self.write("\n".join(command.raw for command in commands))
+        if self._client:
+            await self._client.writer.drain()
+
     async def send_many(
         self,
         cmd_strs: Iterable[str],
@@ -127,8 +218,10 @@ class ArchonController(Device):
         have succeeded). Note that ``done+pending`` can be fewer than the length
         of ``cmd_strs``.
 
-        The order in which the commands are sent and done is not guaranteed. If that's
-        important, you should use `.send_command`.
+        The commands are pipelined: up to ``max_chunk`` commands are in flight at any
+        given time and a new command is sent as soon as one finishes. The order in
+        which the commands are done is not guaranteed, but the returned lists are
+        sorted in the order in which the commands were sent.
 
         Parameters
         ----------
@@ -136,97 +229,128 @@ class ArchonController(Device):
             List of command strings to send. The command ids are assigned automatically
             from available IDs in the pool.
         max_chunk
-            Maximum number of commands to send at once. After sending, waits until all
-            the commands in the chunk are done. This does not guarantee that
-            ``max_chunk`` of commands will be running at once, that depends on the
-            available command ids in the pool.
+            Maximum number of commands to have running at once. This does not
+            guarantee that ``max_chunk`` of commands will be running at once, that
+            depends on the available command ids in the pool.
         timeout
             Timeout for each single command.
         """
-        # Copy the strings so that we can pop them. Also reverse it because
-        # we'll be popping items and we want to conserve the order.
-        cmd_strs = list(cmd_strs)[::-1]
-        done: list[ArchonCommand] = []
+        # Consume the strings lazily so that generators can be streamed.
+        cmd_iter = iter(cmd_strs)
+        sent: list[ArchonCommand] = []
+        pending: set[ArchonCommand] = set()
+        failed = False
 
-        while len(cmd_strs) > 0:
-            pending: list[ArchonCommand] = []
-            if len(cmd_strs) < max_chunk:
-                max_chunk = len(cmd_strs)
-            if len(self._id_pool) >= max_chunk:
-                cmd_ids = (self._get_id() for __ in range(max_chunk))
-            else:
-                cmd_ids = (self._get_id() for __ in range(len(self._id_pool)))
-            for cmd_id in cmd_ids:
-                cmd_str = cmd_strs.pop()
-                cmd = self.send_command(cmd_str, command_id=cmd_id, timeout=timeout)
-                pending.append(cmd)
-            done_cmds: tuple[ArchonCommand] = await asyncio.gather(*pending)
-            if all([cmd.succeeded() for cmd in done_cmds]):
-                done += done_cmds
-                for cmd in done_cmds:
-                    self._id_pool.add(cmd.command_id)
-            else:
-                failed: list[ArchonCommand] = []
-                for cmd in done_cmds:
-                    if cmd.succeeded():
-                        done.append(cmd)
-                    else:
-                        failed.append(cmd)
-                return done, failed
+        while True:
+            # Fill the window with new commands while there are ids available. If
+            # there are no pending commands, we try to get at least one command so
+            # that we fail if the pool is empty. After a failure, stop sending
+            # commands and wait for the ones in flight. The new commands are sent
+            # together with a single write.
+            n_ids = len(self._id_pool)
+            if len(pending) == 0:
+                n_ids = max(n_ids, 1)
+            n_new = 0 if failed else min(max_chunk - len(pending), n_ids)
+
+            new_strs = list(itertools.islice(cmd_iter, n_new))
+            if len(new_strs) > len(self._id_pool):
+                raise ArchonError("No ids reamining in the pool!")
+
+            batch = [
+                self._new_command(cmd_str, self._id_pool.popleft(), timeout=timeout)
+                for cmd_str in new_strs
+            ]
+            pending.update(batch)
 
-        return (done, [])
+            if len(batch) > 0:
+                await self._write_many(batch)
+                sent += batch
+
+            if len(pending) == 0:
+                break
+
+            finished, pending = await asyncio.wait(
+                pending,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            if not failed and not all(cmd.succeeded() for cmd in finished):
+                failed = True
+
+        # The ids have already been returned to the pool as each command finished.
+        done: list[ArchonCommand] = []
+        failed_cmds: list[ArchonCommand] = []
+        for cmd in sent:
+            (done if cmd.succeeded() else failed_cmds).append(cmd)
+
+        return done, failed_cmds
 
     async def process_message(self, line: bytes) -> None:
         """Processes a message from the Archon and associates it with its command."""
-        match = re.match(b"^[<|?]([0-9A-F]{2})", line)
-        if match is None:
-            warnings.warn(f"Received invalid reply {line.decode()}", ArchonUserWarning)
+        # Replies start with <xx, |xx, or ?xx with xx the hexadecimal command id.
+        if (
+            len(line) < 3
+            or line[0] not in REPLY_TYPES
+            or line[1] not in HEX_DIGITS
+            or line[2] not in HEX_DIGITS
+        ):
+            # Warnings are expensive and a noisy connection can produce many invalid
+            # replies, so only some of them are reported as warnings.
+            self._n_invalid_replies += 1
+            message = f"Received invalid reply {line.decode(errors='replace')}"
+            if self._n_invalid_replies % _INVALID_REPLY_WARN_EVERY == 1:
+                warnings.warn(
+                    f"{message} ({self._n_invalid_replies} invalid replies so far).",
+                    ArchonUserWarning,
+                )
+            else:
+                log.debug(message)
+            return
 
-        command_id = int(match[1], 16)
+        command_id = int(line[1:3], 16)
         if command_id not in self.__running_commands:
-            warnings.warn(f"Cannot find running command for {line}", ArchonUserWarning)
+            # This can legitimately happen with late replies to commands that have
+            # already timed out, so it is not reported as a warning.
+            log.debug(f"Cannot find running command for {line}")
             return
 
         self.__running_commands[command_id].process_reply(line)
 
-    async def stop(self):
-        """Stops the client and cancels the command tracker."""
-        self._job.cancel()
-        await super().stop()
-
     async def get_system(self) -> dict[str, Any]:
         """Returns a dictionary with the output of the ``SYSTEM`` command."""
         cmd = await self.send_command("SYSTEM", timeout=1)
         if not cmd.succeeded():
             raise ArchonError(f"Command finished with status {cmd.status.name!r}")
 
-        keywords = str(cmd.replies[0].reply).split()
         system = {}
-        for (key, value) in map(lambda k: k.split("="), keywords):
+        for keyword in _reply_text(cmd).split():
+            key, _, value = keyword.partition("=")
             system[key.lower()] = value
-            if match := re.match(r"^MOD([0-9]{1,2})_TYPE", key, re.IGNORECASE):
-                name_key = f"mod{match.groups()[0]}_name"
-                system[name_key] = ModType(int(value)).name
+            # Add the module name for each MODn_TYPE keyword.
+            key_upper = key.upper()
+            if (
+                key_upper.startswith("MOD")
+                and key_upper.endswith("_TYPE")
+                and key_upper[3:-5].isdigit()
+            ):
+                name_key = f"mod{key_upper[3:-5]}_name"
+                system[name_key] = _modtype_name(int(value))
 
         return system
 
     async def get_status(self) -> dict[str, Any]:
         """Returns a dictionary with the output of the ``STATUS`` command."""
-
-        def check_int(s):
-            if s[0] in ("-", "+"):
-                return s[1:].isdigit()
-            return s.isdigit()
-
         cmd = await self.send_command("STATUS", timeout=1)
         if not cmd.succeeded():
             raise ArchonError(f"Command finished with status {cmd.status.name!r}")
 
-        keywords = str(cmd.replies[0].reply).split()
-        status = {
-            key.lower(): int(value) if check_int(value) else float(value)
-            for (key, value) in map(lambda k: k.split("="), keywords)
-        }
+        status: dict[str, Any] = {}
+        for keyword in _reply_text(cmd).split():
+            key, _, value = keyword.partition("=")
+            try:
+                status[key.lower()] = int(value)
+            except ValueError:
+                status[key.lower()] = float(value)
 
         return status
 
@@ -234,17 +358,29 @@ class ArchonController(Device):
         """Returns the frame information.
 
         All the returned values in the dictionary are integers in decimal
-        representation.
+        representation. If a frame buffer has completed since the last call, the
+        ``_frame_complete`` event is set to wake up any task waiting for a readout.
         """
         cmd = await self.send_command("FRAME", timeout=1)
         if not cmd.succeeded():
             raise ArchonError(f"Command FRAME failed with status {cmd.status.name!r}")
 
-        keywords = str(cmd.replies[0].reply).split()
-        frame = {
-            key.lower(): int(value) if "TIME" not in key else int(value, 16)
-            for (key, value) in map(lambda k: k.split("="), keywords)
-        }
+        frame: dict[str, int] = {}
+        for keyword in _reply_text(cmd).split():
+            key, _, value = keyword.partition("=")
+            try:
+                name, base = _FRAME_KEYS[key]
+            except KeyError:
+                base = 16 if "TIME" in key else 10
+                name, base = _FRAME_KEYS.setdefault(key, (key.lower(), base))
+            frame[name] = int(value, base)
+
+        # Notify anyone waiting for a readout if a buffer has just been completed.
+        for n in [1, 2, 3]:
+            key = f"buf{n}complete"
+            if frame.get(key) == 1 and self._frame_info.get(key) != 1:
+                self._frame_complete.set()
+        self._frame_info = frame
 
         return frame
 
@@ -258,28 +394,46 @@ class ArchonController(Device):
             be saved to ``~/archon_<controller_name>.acf``, or set ``save`` to the path
             of the file to save.
         """
-        key_value_re = re.compile("^(.+?)=(.*)$")
 
-        def parse_line(line):
-            k, v = key_value_re.match(line).groups()
+        def format_line(line):
+            k, _, v = line.partition("=")
             # It seems the GUI replaces / with \ even if that doesn't seem
             # necessary in the INI format.
             k = k.replace("/", "\\")
             if ";" in v or "=" in v or "," in v:
                 v = f'"{v}"'
-            return k, v
+            return f"{k}={v}\n"
+
+        # Read the configuration in chunks of pipelined RCONFIG commands. The end of
+        # the configuration is marked by empty lines, so we stop requesting lines
+        # once we have received two consecutive empty ones.
+        chunk = 200
+        lines: list[str] = []
+        n_blank = 0
+        for n_start in range(0, MAX_CONFIG_LINES, chunk):
+            n_end = min(n_start + chunk, MAX_CONFIG_LINES)
+            done, failed = await self.send_many(
+                _RCONFIG_CMDS[n_start:n_end],
+                max_chunk=chunk,
+                timeout=0.5,
+            )
+            if len(failed) > 0:
+                ff = failed[0]
+                status = ff.status.name
+                raise ArchonError(f"An RCONFIG command returned with code {status!r}")
 
-        cmd_strs = [f"RCONFIG{n_line:04X}" for n_line in range(MAX_CONFIG_LINES)]
-        done, failed = await self.send_many(cmd_strs, max_chunk=200, timeout=0.5)
-        if len(failed) > 0:
-            ff = failed[0]
-            status = ff.status.name
-            raise ArchonError(f"An RCONFIG command returned with code {status!r}")
+            if any([len(cmd.replies) != 1 for cmd in done]):
+                raise ArchonError("Some commands did not get any reply.")
 
-        if any([len(cmd.replies) != 1 for cmd in done]):
-            raise ArchonError("Some commands did not get any reply.")
+            for cmd in done:
+                line = _reply_text(cmd)
+                lines.append(line)
+                n_blank = n_blank + 1 if line == "" else 0
+                if n_blank == 2:
+                    break
 
-        lines = [str(cmd.replies[0]) for cmd in done]
+            if n_blank == 2:
+                break
 
         # Trim possible empty lines at the end.
         config = "\n".join(lines).strip().splitlines()
@@ -289,26 +443,27 @@ class ArchonController(Device):
         # The GUI ACF file includes the system information, so we get it.
         system = await self.get_system()
 
-        c = configparser.ConfigParser()
-        c.optionxform = str  # Make it case-sensitive
-        c.add_section("SYSTEM")
+        # The ACF format is simple enough that we write it directly, in the same
+        # format that ConfigParser would use.
+        acf = io.StringIO()
+        acf.write("[SYSTEM]\n")
         for sk, sv in system.items():
             if "_name" in sk.lower():
                 continue
-            sl = f"{sk.upper()}={sv}"
-            k, v = parse_line(sl)
-            c.set("SYSTEM", k, v)
-        c.add_section("CONFIG")
+            acf.write(format_line(f"{sk.upper()}={sv}"))
+        acf.write("\n[CONFIG]\n")
         for cl in config:
-            k, v = parse_line(cl)
-            c.set("CONFIG", k, v)
+            acf.write(format_line(cl))
+        acf.write("\n")
 
         if isinstance(save, str):
             path = save
         else:
             path = os.path.expanduser(f"~/archon_{self.name}.acf")
-        with open(path, "w") as f:
-            c.write(f, space_around_delimiters=False)
+
+        # Write the file in an executor to avoid blocking the event loop.
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, _write_acf, path, acf.getvalue())
 
         return config
 
@@ -345,19 +500,19 @@ class ArchonController(Device):
         if not os.path.exists(path):
             raise ArchonError(f"File {path} does not exist.")
 
-        c = configparser.ConfigParser()
-        c.read(path)
+        c = _new_acf_parser()
+        await asyncio.get_running_loop().run_in_executor(None, c.read, path)
         if not c.has_section("CONFIG"):
             raise ArchonError("The config file does not have a CONFIG section.")
 
         # Undo the INI format: revert \ to / and remove quotes around values.
         config = c["CONFIG"]
-        lines = list(
-            map(
-                lambda k: k.upper().replace("\\", "/") + "=" + config[k].strip('"'),
-                config,
-            )
-        )
+        lines = [
+            k.upper().replace("\\", "/") + "=" + v.strip('"') for k, v in config.items()
+        ]
+
+        if len(lines) > len(_HEX4):
+            raise ArchonError(f"The configuration has more than {len(_HEX4)} lines.")
 
         notifier("Clearing previous configuration")
         if not (await self.send_command("CLEARCONFIG", timeout=timeout)).succeeded():
@@ -366,7 +521,9 @@ class ArchonController(Device):
 
         notifier("Sending configuration lines")
 
-        cmd_strs = [f"WCONFIG{n_line:04X}{line}" for n_line, line in enumerate(lines)]
+        cmd_strs = [
+            "WCONFIG" + _HEX4[n_line] + line for n_line, line in enumerate(lines)
+        ]
         done, failed = await self.send_many(cmd_strs, max_chunk=200, timeout=timeout)
         if len(failed) > 0:
             ff = failed[0]
@@ -429,6 +586,7 @@ class ArchonController(Device):
         self,
         buffer_no: int = -1,
         notifier: Optional[Callable[[str], None]] = None,
+        frame_info: Optional[dict[str, int]] = None,
     ) -> numpy.ndarray:
         """Fetches a frame buffer and returns a Numpy array.
 
@@ -440,9 +598,13 @@ class ArchonController(Device):
         notifier
             A callback that receives a message with the current operation. Useful when
             `.fetch` is called by the actor to report progress to the users.
+        frame_info
+            The output of `.get_frame` if it has already been retrieved after the
+            buffer was completed. If not provided, `.get_frame` is called.
         """
         notifier = notifier or (lambda x: None)
-        frame_info = await self.get_frame()
+        if frame_info is None:
+            frame_info = await self.get_frame()
 
         if buffer_no not in [1, 2, 3, -1]:
             raise ArchonError(f"Invalid frame buffer {buffer_no}.")
@@ -477,100 +639,188 @@ class ArchonController(Device):
 
         notifier("Reading frame buffer ...")
 
-        # Set the expected length of binary buffer to read, including the prefixes.
-        self.set_binary_reply_size((1024 + 4) * n_blocks)
+        # Set the expected length of binary buffer to read, including the prefix.
+        self.set_binary_reply_size(4 + 1024 * n_blocks)
 
         cmd: ArchonCommand = await self.send_command(
             f"FETCH{start_address:08X}{n_blocks:08X}",
             timeout=None,
         )
 
-        # Unlock all
+        # Unlock all. We don't wait for the reply until we have built the array.
         notifier("Frame buffer readout complete. Unlocking all buffers.")
-        await self.send_command("LOCK0")
-
-        # The full read buffer probably contains some extra bytes to complete the 1024
-        # reply. We get only the bytes we know are part of the buffer.
-        frame = cmd.replies[0].reply[0:n_bytes]
+        unlock_cmd = self.send_command("LOCK0")
 
-        # Convert to uint16 array and reshape.
+        # Convert to uint16 array and reshape. The full read buffer probably contains
+        # some extra bytes to complete the 1024 reply. We create a view on only the
+        # pixels we know are part of the buffer, skipping the <xx: prefix of the raw
+        # reply, which avoids copying the frame again.
         dtype = f"<u{bytes_per_pixel}"  # Buffer is little-endian
-        arr = numpy.frombuffer(frame, dtype=dtype)
+        arr = numpy.frombuffer(
+            cmd.replies[0].raw_reply,
+            dtype=dtype,
+            count=width * height,
+            offset=4,
+        )
         arr = arr.reshape(height, width)
 
+        await unlock_cmd
+
         self.status = ControllerStatus.IDLE
 
         return arr
 
+    async def fetch_split(
+        self,
+        ccds: Iterable[tuple[str, Sequence[int]]],
+        buffer_no: int = -1,
+        notifier: Optional[Callable[[str], None]] = None,
+        frame_info: Optional[dict[str, int]] = None,
+    ) -> dict[str, numpy.ndarray]:
+        """Fetches a frame buffer and splits it into CCD regions.
+
+        Parameters
+        ----------
+        ccds
+            A list of tuples with the name of the CCD and its ``(x0, y0, x1, y1)``
+            region in the buffer.
+        buffer_no
+            The frame buffer number to read. Use ``-1`` to read the most recently
+            complete frame.
+        notifier
+            A callback that receives a message with the current operation.
+        frame_info
+            The output of `.get_frame`, if already available. See `.fetch`.
+
+        Returns
+        -------
+        ccd_data
+            A dictionary of CCD name to a view of its region in the buffer array.
+            No data is copied; writers that need contiguous data make their own copy.
+        """
+        arr = await self.fetch(
+            buffer_no=buffer_no,
+            notifier=notifier,
+            frame_info=frame_info,
+        )
+
+        return {name: arr[y0:y1, x0:x1] for name, (x0, y0, x1, y1) in ccds}
+
     def set_binary_reply_size(self, size: int):
-        """Sets the size of the binary buffers."""
-        self._binary_reply = bytearray(size)
+        """Sets the size of the binary buffers.
+
+        ``size`` is the length of the complete binary reply: the ``<xx:`` prefix
+        followed by the contiguous payload of all the 1024-byte chunks.
+        """
+        if len(self._binary_reply) < size:
+            self._binary_reply.extend(bytes(size - len(self._binary_reply)))
+        self._binary_reply_size = size
 
     async def _listen(self):
         """Listens to the reader stream and callbacks on message received."""
         if not self._client:  # pragma: no cover
             raise RuntimeError("Connection is not open.")
 
+        reader = self._client.reader
+
+        # Read the stream in large chunks and parse as many replies as possible from
+        # each of them, instead of awaiting a read for each part of each reply.
+        buffer = bytearray()
         n_binary = 0
         while True:
-            # Max length of a reply is 1024 bytes for the message preceded by <xx:
-            # We read the first four characters (the maximum length of a complete
-            # message: ?xx\n or <xx\n). If the message ends in a newline, we are done;
-            # if the message ends with ":", it means what follows are 1024 binary
-            # characters without a newline; otherwise, read until the newline which
-            # marks the end of this message. In binary, if the response is < 1024
-            # bytes, the remaining bytes are filled with NULL (0x00).
-            line = await self._client.reader.readexactly(4)
-            if line[-1] == ord(b"\n"):
-                pass
-            elif line[-1] == ord(b":"):
-                line += await self._client.reader.readexactly(1024)
-                # If we know the length of the binary reply to expect, we set that
-                # slice of the bytearray and continue. We wait until all the buffer
-                # has been read before sending the notification. This is significantly
-                # more efficient because we don't create an ArchonCommandReply for each
-                # chunk of the binary reply. It is, however, necessary to know the
-                # exact size of the reply because there is nothing that we can parse
-                # to know a reply is the last one. Also, we don't want to keep appending
-                # to a bytes string. We need to allocate all the memory first with
-                # a bytearray or it's very inefficient.
-                #
-                # NOTE: this assumes that once the binary reply begins, no no other
-                # reply is going to arrive in the middle of it. I think that's unlikely,
-                # and probably prevented by the controller, but it's worth keeping in
-                # mind.
-                #
-                if self._binary_reply:
-                    self._binary_reply[n_binary : n_binary + 1028] = line
-                    n_binary += 1028  # How many bytes of the binary reply have we read.
-                    if n_binary == len(self._binary_reply):
-                        # This was the last chunk. Set line to the full reply and
-                        # reset the binary reply and counter.
-                        line = self._binary_reply
-                        self._binary_reply = None
+            data = await reader.read(2**16)
+            if not data:
+                break
+            buffer += data
+
+            # A complete message is at least four characters long: ?xx\n or <xx\n. If
+            # the fourth character is a newline, we are done; if it is ":", it means
+            # what follows are 1024 binary characters without a newline; otherwise,
+            # the message continues until the next newline. In binary, if the
+            # response is < 1024 bytes, the remaining bytes are filled with NULL
+            # (0x00). If the message is not complete, wait for more data.
+            #
+            # We keep track of where the next message starts and only discard the
+            # parsed messages from the buffer once all the complete ones have been
+            # processed, instead of shifting the buffer after each of them.
+            #
+            # The chunks are copied out of the buffer through a memoryview, so that
+            # slicing does not create an intermediate copy of each of them. The view
+            # must be released before the buffer is resized below, so the slices are
+            # never bound to a name.
+            start = 0
+            with memoryview(buffer) as view:
+                while len(buffer) - start >= 4:
+                    marker = buffer[start + 3]
+                    if marker == _NEWLINE:
+                        end = start + 4
+                    elif marker == _COLON:
+                        end = start + 1028
+                        if len(buffer) < end:
+                            break
+                    else:
+                        end = buffer.find(b"\n", start + 4) + 1
+                        if end == 0:
+                            break
+
+                    # If we know the length of the binary reply to expect, we set that
+                    # slice of the bytearray and continue. We wait until all the buffer
+                    # has been read before sending the notification. This is
+                    # significantly more efficient because we don't create an
+                    # ArchonCommandReply for each chunk of the binary reply. It is,
+                    # however, necessary to know the exact size of the reply because
+                    # there is nothing that we can parse to know a reply is the last
+                    # one. Also, we don't want to keep appending to a bytes string. We
+                    # need to allocate all the memory first with a bytearray or it's
+                    # very inefficient. Only the <xx: prefix of the first chunk is kept,
+                    # so that the payload is contiguous after the first four bytes.
+                    #
+                    # NOTE: this assumes that once the binary reply begins, no no other
+                    # reply is going to arrive in the middle of it. I think that's
+                    # unlikely, and probably prevented by the controller, but it's worth
+                    # keeping in mind.
+                    #
+                    if marker == _COLON and self._binary_reply_size > 0:
+                        if n_binary == 0:
+                            self._binary_reply[0:1028] = view[start:end]
+                            n_binary = 1028
+                        else:
+                            self._binary_reply[n_binary : n_binary + 1024] = view[
+                                start + 4 : end
+                            ]
+                            # How many bytes of the binary reply we read.
+                            n_binary += 1024
+                        start = end
+
+                        if n_binary < self._binary_reply_size:
+                            # Skip notifying because the binary reply is incomplete.
+                            continue
+
+                        # This was the last chunk. Copy the full reply out of the
+                        # buffer, which will be reused for the next one, and reset the
+                        # expected size and counter. The copy is a bytearray so that
+                        # the arrays built on it by fetch() are writeable.
+                        line = self._binary_reply[:n_binary]
+                        self._binary_reply_size = 0
                         n_binary = 0
                     else:
-                        # Skip notifying because the binary reply is still incomplete.
-                        continue
-            else:
-                line += await self._client.reader.readuntil(b"\n")
+                        line = bytes(view[start:end])
+                        start = end
+
+                    self.notify(line)
+
+            del buffer[:start]
 
-            self.notify(line)
+    def _on_command_done(self, command: ArchonCommand):
+        """Stops tracking a finished command and returns its id to the pool."""
+        command_id = command.command_id
+        # Only release the id if it still belongs to this command.
+        if self.__running_commands.get(command_id) is command:
+            self.__running_commands.pop(command_id)
+            self._id_pool.append(command_id)
 
     def _get_id(self) -> int:
         """Returns an identifier from the pool."""
         if len(self._id_pool) == 0:
             raise ArchonError("No ids reamining in the pool!")
-        return self._id_pool.pop()
-
-    async def __track_commands(self):
-        """Removes complete commands from the list of running commands."""
-        while True:
-            done_cids = []
-            for cid in self.__running_commands.keys():
-                if self.__running_commands[cid].done():
-                    self._id_pool.add(cid)
-                    done_cids.append(cid)
-            for cid in done_cids:
-                self.__running_commands.pop(cid)
-            await asyncio.sleep(0.5)
+        return self._id_pool.popleft()
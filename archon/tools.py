@@ -14,30 +14,44 @@ __all__ = ["Timer"]
 
 
 class Timer:
-    """An asynchronous timer."""
+    """An asynchronous timer.
+
+    Resetting the timer only records when it happened. Once the original timeout
+    expires the timer checks if it has been reset in the meantime and, if so, waits for
+    the remaining time. This makes `.reset` cheap enough to be called for each reply.
+    """
 
     def __init__(self, timeout: float, callback):
         self._timeout = timeout
         self._callback = callback
 
         self._loop = asyncio.get_event_loop()
-        self._task: asyncio.Task | None = None
+        self._handle: asyncio.TimerHandle | None = None
+        self._last_reset: float = 0.0
 
         self.reset()
 
-    async def _job(self):
-        await asyncio.sleep(self._timeout)
-        try:
-            await self._callback()
-        except TypeError:  # Happens when the callback becomes None during an error.
-            pass
+    def _run(self):
+        remaining = self._last_reset + self._timeout - self._loop.time()
+        if remaining > 0:
+            self._handle = self._loop.call_later(remaining, self._run)
+            return
+
+        self._handle = None
+        if self._callback is None:  # Happens when the callback is removed on error.
+            return
+        result = self._callback()
+        if asyncio.iscoroutine(result):
+            self._loop.create_task(result)
 
     def cancel(self):
         """Cancel the timer."""
-        if self._task:
-            self._task.cancel()
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
 
     def reset(self):
         """Reset the count."""
-        self.cancel()
-        self._task = self._loop.create_task(self._job())
+        self._last_reset = self._loop.time()
+        if self._handle is None:
+            self._handle = self._loop.call_later(self._timeout, self._run)
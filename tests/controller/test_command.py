@@ -10,8 +10,8 @@ import asyncio
 
 import pytest
 
-from archon.controller.command import ArchonCommand
-from archon.exceptions import ArchonUserWarning
+from archon.controller.command import ArchonCommand, ArchonCommandReply
+from archon.exceptions import ArchonError, ArchonUserWarning
 
 pytestmark = [pytest.mark.asyncio]
 
@@ -32,6 +32,18 @@ def test_command_process_bad_reply(reply):
     assert command.status == command.status.FAILED
 
 
+@pytest.mark.parametrize("reply", [b"", b"!01PONG", b"<0GPONG"])
+def test_command_reply_unparseable(reply):
+    with pytest.raises(ArchonError):
+        ArchonCommandReply(reply, ArchonCommand("ping", 1))
+
+
+def test_command_reply_binary_newline():
+    reply = ArchonCommandReply(b"<01:12\n34", ArchonCommand("ping", 1))
+    assert reply.is_binary
+    assert reply.reply == b"12\n34"
+
+
 def test_command_process_reply_failed():
     command = ArchonCommand("ping", 1)
     command.process_reply(b"?01")
@@ -55,6 +67,17 @@ async def test_command_timeout():
     assert command.status == command.status.TIMEDOUT
 
 
+async def test_command_timeout_reset_by_replies():
+    # Each reply arrives well before the timeout but, together, they take longer.
+    command = ArchonCommand("ping", 1, expected_replies=3, timeout=0.2)
+    for _ in range(2):
+        await asyncio.sleep(0.12)
+        command.process_reply(b"<01pong")
+    assert command.status == command.status.RUNNING
+    await asyncio.sleep(0.3)
+    assert command.status == command.status.TIMEDOUT
+
+
 async def test_command_get_replies():
     async def background(command: ArchonCommand):
         command.process_reply(b"<01pong1")
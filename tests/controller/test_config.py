@@ -8,7 +8,7 @@
 
 import unittest.mock
 
-from typing import Callable, Generator, Optional
+from typing import Callable, Generator, Iterable, List, Optional
 
 import pytest
 
@@ -54,11 +54,22 @@ def send_command(parser: Optional[Callable[[ArchonCommand], ArchonCommand]] = No
     return send_command_internal
 
 
+def send_many(parser: Optional[Callable[[ArchonCommand], ArchonCommand]] = None):
+    send_command_internal = send_command(parser)
+
+    async def send_many_internal(cmd_strs: Iterable[str], **kwargs):
+        cmds = [send_command_internal(cmd_str) for cmd_str in cmd_strs]
+        done = [cmd for cmd in cmds if cmd.succeeded()]
+        return done, [cmd for cmd in cmds if not cmd.succeeded()]
+
+    return send_many_internal
+
+
 async def test_read_config(controller: ArchonController, mocker):
     mocker.patch.object(
         ArchonController,
-        "send_command",
-        side_effect=send_command(),
+        "send_many",
+        side_effect=send_many(),
     )
 
     config = await controller.read_config()
@@ -66,6 +77,21 @@ async def test_read_config(controller: ArchonController, mocker):
     assert config[0] == "LINE0=0"
 
 
+async def test_read_config_stops_at_end(controller: ArchonController, mocker):
+    mocker.patch.object(archon.controller.controller, "MAX_CONFIG_LINES", 1000)
+    send_many_mock = mocker.patch.object(
+        ArchonController,
+        "send_many",
+        side_effect=send_many(),
+    )
+
+    config = await controller.read_config()
+    assert len(config) == 5
+
+    n_sent = sum([len(call.args[0]) for call in send_many_mock.call_args_list])
+    assert n_sent < 1000
+
+
 async def test_read_config_fails(controller: ArchonController, mocker):
     def parser(cmd: ArchonCommand):
         cmd._mark_done(ArchonCommandStatus.FAILED)
@@ -74,8 +100,8 @@ async def test_read_config_fails(controller: ArchonController, mocker):
 
     mocker.patch.object(
         ArchonController,
-        "send_command",
-        side_effect=send_command(parser),
+        "send_many",
+        side_effect=send_many(parser),
     )
 
     with pytest.raises(ArchonError):
@@ -90,8 +116,8 @@ async def test_read_config_no_reply(controller: ArchonController, mocker):
 
     mocker.patch.object(
         ArchonController,
-        "send_command",
-        side_effect=send_command(parser),
+        "send_many",
+        side_effect=send_many(parser),
     )
 
     with pytest.raises(ArchonError):
@@ -100,6 +126,11 @@ async def test_read_config_no_reply(controller: ArchonController, mocker):
 
 @pytest.mark.parametrize("path", [True, "/home/test/test.acf"])
 async def test_read_config_save(controller: ArchonController, mocker, path):
+    mocker.patch.object(
+        ArchonController,
+        "send_many",
+        side_effect=send_many(),
+    )
     mocker.patch.object(
         ArchonController,
         "send_command",
@@ -115,6 +146,36 @@ async def test_read_config_save(controller: ArchonController, mocker, path):
     assert open_patch.called_once()
 
 
+async def test_read_config_save_content(controller: ArchonController, mocker, tmp_path):
+    mocker.patch.object(
+        ArchonController,
+        "send_many",
+        side_effect=send_many(),
+    )
+    mocker.patch.object(
+        ArchonController,
+        "send_command",
+        side_effect=send_command(),
+    )
+
+    path = tmp_path / "test.acf"
+    await controller.read_config(save=str(path))
+
+    assert path.read_text() == (
+        "[SYSTEM]\n"
+        "SYSTEM=0\n"
+        "MOD1_TYPE=1\n"
+        "\n"
+        "[CONFIG]\n"
+        "LINE0=0\n"
+        "LINE1=1\n"
+        "LINE2=2\n"
+        'LINE3="3=3"\n'
+        'LINE4="4=4"\n'
+        "\n"
+    )
+
+
 @pytest.fixture()
 def config_file(tmp_path):
     config_ = tmp_path / "config.acf"
@@ -138,13 +199,42 @@ def send_command_mock(
     )
 
 
-async def test_write_config(
-    controller: ArchonController, send_command_mock, config_file
+@pytest.fixture()
+def write_mock(controller, mocker) -> Generator[unittest.mock.MagicMock, None, None]:
+    yield mocker.patch.object(controller, "write", wraps=controller.write)
+
+
+def get_written_commands(write_mock: unittest.mock.MagicMock) -> List[str]:
+    """Returns the command strings, without the command id, sent to the Archon."""
+    data = "\n".join([call.args[0] for call in write_mock.call_args_list])
+    return [line[3:] for line in data.splitlines()]
+
+
+async def test_write_config(controller: ArchonController, write_mock, config_file):
+    await controller.write_config(config_file)
+    assert "WCONFIG0000CONFIG/1=1" in get_written_commands(write_mock)
+
+
+async def test_write_config_many_lines(
+    controller: ArchonController, write_mock, tmp_path
 ):
+    config_file = tmp_path / "config.acf"
+    with open(config_file, "w") as f:
+        f.write("[CONFIG]\n")
+        for n in range(500):
+            f.write(f"CONFIG\\{n}={n}\n")
+
     await controller.write_config(config_file)
-    send_command_mock.assert_any_call(
-        "WCONFIG0000CONFIG/1=1", timeout=1, command_id=unittest.mock.ANY
-    )
+
+    wconfig_cmds = [
+        cmd_str
+        for cmd_str in get_written_commands(write_mock)
+        if cmd_str.startswith("WCONFIG")
+    ]
+    assert wconfig_cmds == [f"WCONFIG{n:04X}CONFIG/{n}={n}" for n in range(500)]
+
+    # Commands are sent in batches, not one write per line.
+    assert write_mock.call_count < 500
 
 
 async def test_write_config_applyall_poweron(
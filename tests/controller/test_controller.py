@@ -7,6 +7,7 @@
 # @License: BSD 3-clause (http://www.opensource.org/licenses/BSD-3-Clause)
 
 import asyncio
+import warnings
 
 import pytest
 
@@ -54,11 +55,88 @@ async def test_controller_command_not_running(controller: ArchonController):
         await asyncio.sleep(0.01)
 
 
+@pytest.mark.parametrize("reply", ["!01PONG", "<0aPONG", "<-1PONG", "<", "?1", "| 1"])
+async def test_controller_invalid_reply(controller: ArchonController, reply: str):
+    with pytest.warns(ArchonUserWarning, match="Received invalid reply"):
+        await controller.process_message(reply.encode())
+
+
+async def test_controller_invalid_reply_rate_limited(controller: ArchonController):
+    with pytest.warns(ArchonUserWarning, match="Received invalid reply") as record:
+        for _ in range(3):
+            await controller.process_message(b"!01PONG")
+    assert len(record) == 1
+    assert controller._n_invalid_replies == 3
+
+
 @pytest.mark.commands([["PING", ["<02PONG"]]])
-async def test_controller_bad_reply(controller: ArchonController):
-    with pytest.warns(ArchonUserWarning):
-        controller.send_command("ping", command_id=1)
-        await asyncio.sleep(0.01)
+async def test_controller_bad_reply(controller: ArchonController, caplog):
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        command = controller.send_command("ping", command_id=1, timeout=0.05)
+        await command
+
+    assert command.status == command.status.TIMEDOUT
+    assert "Cannot find running command" in caplog.text
+
+
+@pytest.mark.commands([["PING", ["<{cid}PONG"]]])
+@pytest.mark.parametrize(
+    "command_string,status",
+    [("PING", "DONE"), ("FOO", "TIMEDOUT")],
+)
+async def test_controller_release_id(
+    controller: ArchonController,
+    command_string: str,
+    status: str,
+):
+    running_commands = controller._ArchonController__running_commands
+
+    command = controller.send_command(command_string, command_id=10, timeout=0.05)
+    assert 10 not in controller._id_pool
+    assert 10 in running_commands
+
+    # The id is returned as soon as the command is done, without polling.
+    await command
+    assert command.status.name == status
+    assert 10 in controller._id_pool
+    assert 10 not in running_commands
+
+
+async def test_controller_id_pool_per_instance():
+    controller1 = ArchonController("localhost")
+    controller2 = ArchonController("localhost")
+
+    controller1._get_id()
+    assert len(controller1._id_pool) == len(controller2._id_pool) - 1
+    assert (
+        controller1._ArchonController__running_commands
+        is not controller2._ArchonController__running_commands
+    )
+
+
+@pytest.mark.commands([["PING", ["<{cid}PONG"]]])
+async def test_controller_command_id_zero(controller: ArchonController):
+    command = controller.send_command("PING", command_id=0)
+    assert command.command_id == 0
+    assert command.raw == ">00PING"
+
+    await command
+    assert command.succeeded()
+
+
+@pytest.mark.commands([])
+async def test_controller_command_id_in_use(controller: ArchonController):
+    command = controller.send_command("PING", command_id=5, timeout=0.05)
+    with pytest.raises(ArchonError):
+        controller.send_command("PING", command_id=5)
+
+    # The rejected command must not release the id of the running one.
+    assert controller._ArchonController__running_commands[5] is command
+    assert 5 not in controller._id_pool
+
+    await command
+    assert list(controller._id_pool).count(5) == 1
 
 
 @pytest.mark.commands([])
@@ -68,6 +146,47 @@ async def test_controller_bad_command_id(controller: ArchonController, command_i
         controller.send_command("PING", command_id=command_id)
 
 
+@pytest.mark.commands([["PING", ["<{cid}PONG"]]])
+async def test_controller_send_many(controller: ArchonController):
+    cmd_strs = [f"PING {n}" for n in range(300)]
+    done, failed = await controller.send_many(cmd_strs, max_chunk=20, timeout=1)
+    assert len(failed) == 0
+    assert [cmd.command_string for cmd in done] == cmd_strs
+
+
+@pytest.mark.commands([["PING", ["<{cid}PONG"]], ["STATUS", ["?{cid}"]]])
+async def test_controller_send_many_fails(controller: ArchonController):
+    # STATUS fails. No new commands are sent after that.
+    cmd_strs = ["PING"] * 5 + ["STATUS"] + ["PING"] * 100
+    done, failed = await controller.send_many(cmd_strs, max_chunk=5, timeout=1)
+    assert [cmd.command_string for cmd in failed] == ["STATUS"]
+    assert len(done) + len(failed) < len(cmd_strs)
+    assert len(controller._id_pool) == 255
+
+
+async def test_controller_listen_split_replies(mocker):
+    controller = ArchonController("localhost")
+    notify = mocker.patch.object(controller, "notify")
+
+    reader = asyncio.StreamReader()
+    controller._client = mocker.MagicMock(reader=reader)
+
+    # Replies split across reads and several replies in a single read.
+    binary = b"<03:" + b"1" * 1024
+    data = b"<01PONG\n?02\n" + binary + b"<04\n"
+
+    async def feed():
+        for chunk in [data[:2], data[2:10], data[10:600], data[600:]]:
+            reader.feed_data(chunk)
+            await asyncio.sleep(0.01)
+        reader.feed_eof()
+
+    await asyncio.gather(controller._listen(), feed())
+
+    lines = [call.args[0] for call in notify.call_args_list]
+    assert lines == [b"<01PONG\n", b"?02\n", binary, b"<04\n"]
+
+
 @pytest.mark.commands([["FASTLOADPARAM", ["<{cid}"]]])
 async def test_controller_set_param(controller: ArchonController):
     cmd = await controller.set_param("A", 1)
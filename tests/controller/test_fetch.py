@@ -37,6 +37,82 @@ async def test_fetch(controller: ArchonController, buffer):
     assert arr.dtype == "uint16"
 
 
+@pytest.mark.commands(
+    [
+        [
+            "FRAME",
+            [
+                "<{cid}WBUF=3 BUF1COMPLETE=1 BUF2COMPLETE=0 BUF3COMPLETE=0 "
+                "BUF1TIMESTAMP=0 BUF1WIDTH=640 BUF1HEIGHT=480 BUF1SAMPLE=0 "
+                "BUF1BASE=0000000000"
+            ],
+        ],
+        ["FETCH", [(b"<{cid}:" + b"0" * 1024) * 600]],
+    ]
+)
+async def test_fetch_split(controller: ArchonController):
+    ccds = [("ccd1", (0, 0, 320, 480)), ("ccd2", (320, 0, 640, 480))]
+    ccd_data = await controller.fetch_split(ccds, buffer_no=1)
+    assert list(ccd_data) == ["ccd1", "ccd2"]
+    assert ccd_data["ccd1"].shape == (480, 320)
+    assert numpy.shares_memory(ccd_data["ccd1"].base, ccd_data["ccd2"])
+
+
+@pytest.mark.commands(
+    [
+        [
+            "FRAME",
+            [
+                "<{cid}WBUF=3 BUF1COMPLETE=1 BUF2COMPLETE=0 BUF3COMPLETE=0 "
+                "BUF1TIMESTAMP=0 BUF1WIDTH=512 BUF1HEIGHT=600 BUF1SAMPLE=0 "
+                "BUF1BASE=0000000000"
+            ],
+        ],
+        ["FETCH", [b"".join(b"<{cid}:" + bytes([n % 256]) * 1024 for n in range(600))]],
+    ]
+)
+async def test_fetch_data(controller: ArchonController):
+    arr = await controller.fetch(1)
+    assert arr.shape == (600, 512)
+
+    # Each row of the frame comes from a different binary chunk.
+    expected = (numpy.arange(600) % 256) * 257
+    assert numpy.all(arr == expected[:, numpy.newaxis])
+
+    # The frame can be modified in place, for example to subtract a bias.
+    assert arr.flags.writeable
+
+    # The binary buffer is reused for the next fetch, and the returned array must
+    # not be a view of it.
+    binary_reply = controller._binary_reply
+    buffer_array = numpy.frombuffer(binary_reply, dtype="u1")
+    assert not numpy.shares_memory(arr, buffer_array)
+    del buffer_array
+
+    # The array is a view of the complete raw reply, prefix included, so the
+    # payload has been copied only once.
+    assert len(arr.base.base) == 4 + 1024 * 600
+
+    await controller.fetch(1)
+    assert controller._binary_reply is binary_reply
+
+
+@pytest.mark.commands([["FETCH", [(b"<{cid}:" + b"0" * 1024) * 600]]])
+async def test_fetch_frame_info(controller: ArchonController, mocker):
+    get_frame = mocker.patch.object(controller, "get_frame")
+    frame_info = {
+        "buf1complete": 1,
+        "buf1width": 640,
+        "buf1height": 480,
+        "buf1sample": 0,
+        "buf1base": 0,
+    }
+
+    arr = await controller.fetch(1, frame_info=frame_info)
+    assert arr.shape == (480, 640)
+    get_frame.assert_not_called()
+
+
 async def test_fetch_bad_buffer(controller: ArchonController):
     with pytest.raises(ArchonError):
         await controller.fetch(5)
@@ -28,3 +28,10 @@ async def test_get_frame(controller: ArchonController):
 async def test_get_frame_fails(controller: ArchonController):
     with pytest.raises(ArchonError):
         await controller.get_frame()
+
+
+@pytest.mark.commands([["FRAME", ["<{cid}WBUF=1 BUF1COMPLETE=1 BUF2COMPLETE=0"]]])
+async def test_get_frame_complete_event(controller: ArchonController):
+    assert not controller._frame_complete.is_set()
+    await controller.get_frame()
+    assert controller._frame_complete.is_set()